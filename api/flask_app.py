@@ -1,27 +1,30 @@
 import os
+import sys
 import time
-import psutil
+import hashlib
+import logging
+import resource
+import threading
 import numpy as np
 import tempfile
 import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
-# --- NumPy compatibility shim (for older libs like resemblyzer) ---
-# NumPy >= 1.24 removed np.bool, np.int, np.float; some libs still reference them.
-if not hasattr(np, "bool"):
-    np.bool = np.bool_  # type: ignore[attr-defined]
-if not hasattr(np, "int"):
-    np.int = int  # type: ignore[attr-defined]
-if not hasattr(np, "float"):
-    np.float = float  # type: ignore[attr-defined]
-# ------------------------------------------------------------------
-
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from werkzeug.exceptions import BadRequest, HTTPException
+from werkzeug.utils import secure_filename
+
+# voice_core lives at the repo root, next to the other entry points; make it
+# importable when this file is run directly (python api/flask_app.py)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import voice_core
+from voice_core import EXECUTOR, EmbeddingCache, LRUCache, make_private_dir, similarity
 
-# Import after the NumPy shim so resemblyzer sees the aliases
-from resemblyzer import VoiceEncoder, preprocess_wav
+from resemblyzer import preprocess_wav
 
 import requests
 import librosa
@@ -31,23 +34,91 @@ import soundfile as sf
 import imageio_ffmpeg
 FFMPEG_BIN = imageio_ffmpeg.get_ffmpeg_exe()  # full path to bundled ffmpeg
 
+# PyAV (libav bindings) decodes in-process, avoiding an ffmpeg fork+exec
+# per clip. Optional: without it we shell out to the bundled ffmpeg.
+try:
+    import av
+except ImportError:
+    av = None
+
+# orjson serializes responses in C, several times faster than the stdlib
+# json module. Optional: without it Flask's default provider is used.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class ORJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider backed by orjson (always compact; numpy scalars
+    and arrays are serialized natively).
+    """
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+# Lazy %-style logging: debug messages cost nothing unless LOG_LEVEL=DEBUG.
+# Set LOG_LEVEL=WARNING in production to keep only fallbacks and errors.
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
+if orjson is not None:
+    app.json = ORJSONProvider(app)
+app.json.compact = True  # no pretty-printing, even in debug
 
 # CORS
 CORS(
     app,
     origins=["*"],
     methods=["GET", "POST"],
-    allow_headers=["Content-Type"],
+    allow_headers=[
+        "Content-Type",
+        "X-Audio1-Length",
+        "X-Audio2-Length",
+        "X-Audio1-Filename",
+        "X-Audio2-Filename",
+    ],
+    max_age=86400,  # let browsers cache the preflight for a day
 )
 
 # Config
 ALLOWED_EXTENSIONS = {"wav", "mp3", "m4a", "flac", "ogg", "webm"}
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB
 app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
-
-# Speaker encoder
-encoder = VoiceEncoder()
+SIMILARITY_THRESHOLD = 0.70
+MAX_CANDIDATES = 50  # per /compare_many request
+# Per-request pool size for the many-clip endpoints (downloads, decoding and
+# preprocessing of one request; the network part wants a few more threads
+# than there are cores)
+FANOUT_WORKERS = int(os.environ.get("FANOUT_WORKERS", min(8, 2 * (os.cpu_count() or 1))))
+
+# Second tier for preprocessed wavs: raw float32 files on tmpfs, memory-mapped
+# on a hit, so every gunicorn worker shares one copy through the page cache.
+# Oldest files are evicted to keep SHM_CACHE_MIN_FREE of the tmpfs free.
+# Set SHM_CACHE_DIR to an empty string to disable. It is also disabled on
+# hosts without /dev/shm, and when the directory isn't private to this uid
+# (/dev/shm is world-writable, so anyone could plant or read entries).
+SHM_CACHE_DIR = os.environ.get("SHM_CACHE_DIR", f"/dev/shm/vsm_cache-{os.getuid()}")
+SHM_CACHE_MIN_FREE = 0.25  # fraction of the tmpfs
+if SHM_CACHE_DIR and not make_private_dir(SHM_CACHE_DIR):
+    SHM_CACHE_DIR = ""
+
+# Shared HTTP session: keeps connections to the audio hosts alive between
+# requests. The pool is sized for the concurrent downloads of /compare_many.
+HTTP = requests.Session()
+HTTP.headers.update({
+    "User-Agent": "VoiceSimilarityMatcher/1.0",
+    "Accept": "audio/*,*/*;q=0.9",
+})
+HTTP.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=8))
+HTTP.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=8))
 
 def allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -70,61 +141,112 @@ def get_filename_from_url(url: str) -> str:
         fname = f"audio_{int(time.time())}.webm"
     return fname
 
-def download_audio_from_url(url: str, out_path: str) -> str:
+def download_audio_from_url(url: str, out_path: str) -> tuple:
+    """
+    Stream a URL to disk, hashing the bytes as they are written and
+    enforcing MAX_CONTENT_LENGTH as they arrive (uploads get that cap from
+    Flask; downloads would otherwise be unbounded).
+    Returns (out_path, sha256 hex digest).
+    """
     try:
-        print(f"Downloading audio from URL: {url}")
-        headers = {
-            "User-Agent": "VoiceSimilarityMatcher/1.0",
-            "Accept": "audio/*,*/*;q=0.9",
-        }
-        with requests.get(url, headers=headers, timeout=30, stream=True) as r:
+        logger.debug("Downloading audio from URL: %s", url)
+        h = hashlib.sha256()
+        total = 0
+        with HTTP.get(url, timeout=30, stream=True) as r:
             r.raise_for_status()
+            # Reject up front when the server announces an oversized body
+            if int(r.headers.get("Content-Length") or 0) > MAX_CONTENT_LENGTH:
+                raise ValueError(f"file exceeds {MAX_CONTENT_LENGTH >> 20} MB")
+            # Read straight from urllib3 in 1 MB slabs instead of 8 KB
+            # iter_content chunks: far fewer Python iterations and write()s.
+            # Decoded bytes are counted, so a compressed body can't slip past.
+            r.raw.decode_content = True
             with open(out_path, "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
+                while chunk := r.raw.read(1 << 20):
+                    total += len(chunk)
+                    if total > MAX_CONTENT_LENGTH:
+                        raise ValueError(f"file exceeds {MAX_CONTENT_LENGTH >> 20} MB")
+                    h.update(chunk)
                     f.write(chunk)
-        print(f"Successfully downloaded audio to: {out_path}")
-        return out_path
+        logger.debug("Successfully downloaded audio to: %s", out_path)
+        return out_path, h.hexdigest()
     except Exception as e:
         raise Exception(f"Failed to download audio from URL: {e}")
 
-def convert_to_wav_ffmpeg(input_path: str, output_path: str) -> str:
+def is_natively_decodable(path: str) -> bool:
+    """
+    Header-only probe via libsndfile. If it can open the file (wav/flac/ogg,
+    and mp3 on libsndfile >= 1.1), preprocess_wav decodes and resamples it
+    in-process and the ffmpeg transcode can be skipped.
+    """
+    try:
+        info = sf.info(path)
+    except Exception:
+        return False
+    return info.frames > 0 and info.samplerate > 0
+
+# ffmpeg output options: 16 kHz mono raw s16le PCM, written to a pipe
+FFMPEG_PCM_OPTS = ["-vn", "-ac", "1", "-ar", "16000", "-f", "s16le", "-acodec", "pcm_s16le"]
+
+def pcm16_to_float32(data) -> np.ndarray:
+    if len(data) == 0:
+        raise RuntimeError("decoder produced empty output")
+    # Cast once, then scale in place by the float32 reciprocal: no float64
+    # intermediate and no second full-size temporary
+    wav = np.frombuffer(data, dtype=np.int16).astype(np.float32)
+    wav *= np.float32(1.0 / 32768.0)
+    return wav
+
+def decode_audio_av(input_path: str) -> np.ndarray:
+    """
+    Decode in-process with PyAV, resampling to 16 kHz mono s16 as frames
+    come out of the decoder. No subprocess at all.
+    """
+    logger.debug("Decoding %s using PyAV", input_path)
+    chunks = []
+    with av.open(input_path) as container:
+        resampler = av.AudioResampler(format="s16", layout="mono", rate=16000)
+        for frame in container.decode(audio=0):
+            for out in resampler.resample(frame):
+                chunks.append(out.to_ndarray().reshape(-1))
+        for out in resampler.resample(None):  # flush
+            chunks.append(out.to_ndarray().reshape(-1))
+    if not chunks:
+        raise RuntimeError("PyAV decoded no audio")
+    return pcm16_to_float32(np.concatenate(chunks))
+
+def decode_audio_ffmpeg(input_path: str) -> np.ndarray:
     """
-    Convert with bundled ffmpeg. Handles webm/ogg/mp3/m4a/flac reliably.
+    Decode with bundled ffmpeg straight into a 16 kHz mono float32 array
+    (raw PCM on stdout, no intermediate WAV). Handles webm/ogg/mp3/m4a/flac.
     """
     try:
         if not FFMPEG_BIN or not os.path.exists(FFMPEG_BIN):
-            print("Bundled ffmpeg not found, falling back to librosa")
-            return convert_to_wav_librosa(input_path, output_path)
+            logger.warning("Bundled ffmpeg not found, falling back to librosa")
+            return decode_audio_librosa(input_path)
 
-        print(f"Converting {input_path} -> {output_path} using ffmpeg at {FFMPEG_BIN}")
+        logger.debug("Decoding %s using ffmpeg at %s", input_path, FFMPEG_BIN)
 
         cmd = [
             FFMPEG_BIN,
             "-hide_banner", "-loglevel", "error",
-            "-y",
             "-i", input_path,
-            "-vn",
-            "-ac", "1",
-            "-ar", "16000",
-            "-acodec", "pcm_s16le",
-            output_path,
+            *FFMPEG_PCM_OPTS,
+            "pipe:1",
         ]
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        result = subprocess.run(cmd, capture_output=True)
         if result.returncode != 0:
-            print("ffmpeg stderr:", result.stderr)
+            logger.warning("ffmpeg stderr: %s", result.stderr.decode(errors="replace"))
             raise RuntimeError("ffmpeg failed")
 
-        if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
-            raise RuntimeError("ffmpeg produced empty output")
-
-        print(f"ffmpeg conversion successful: {output_path}")
-        return output_path
+        wav = pcm16_to_float32(result.stdout)
+        logger.debug("ffmpeg decoding successful: %s", input_path)
+        return wav
     except Exception as e:
-        print(f"ffmpeg conversion failed: {e}")
-        print("Falling back to librosa")
-        return convert_to_wav_librosa(input_path, output_path)
+        logger.warning("ffmpeg decoding failed, falling back to librosa: %s", e)
+        return decode_audio_librosa(input_path)
 
-def convert_to_wav_librosa(input_path: str, output_path: str) -> str:
+def decode_audio_librosa(input_path: str) -> np.ndarray:
     """
     Fallback via librosa/soundfile.
     NOTE: libsndfile cannot decode webm/ogg; raise early in that case.
@@ -134,65 +256,276 @@ def convert_to_wav_librosa(input_path: str, output_path: str) -> str:
         raise Exception("librosa/soundfile cannot decode WebM/Ogg without ffmpeg.")
 
     try:
-        print(f"Converting {input_path} -> {output_path} using librosa")
-        audio_data, sample_rate = librosa.load(input_path, sr=16000, mono=True)
-        sf.write(output_path, audio_data, sample_rate, subtype="PCM_16")
-        print(f"librosa conversion successful: {output_path}")
-        return output_path
+        logger.debug("Decoding %s using librosa", input_path)
+        wav, _ = librosa.load(input_path, sr=16000, mono=True, dtype=np.float32)
+        logger.debug("librosa decoding successful: %s", input_path)
+        return wav
     except Exception as e:
-        raise Exception(f"Error converting audio with librosa: {e}")
+        raise Exception(f"Error decoding audio with librosa: {e}")
 
-def convert_to_wav(input_path: str, output_path: str) -> str:
+def decode_audio(input_path: str) -> np.ndarray:
     """
-    Preferred path: ffmpeg; fallback: librosa (non-webm/ogg).
+    Preferred path: PyAV in-process; then the ffmpeg binary; fallback:
+    librosa (non-webm/ogg).
     """
     try:
-        return convert_to_wav_ffmpeg(input_path, output_path)
+        if av is not None:
+            try:
+                return decode_audio_av(input_path)
+            except Exception as e:
+                logger.warning("PyAV decoding failed, falling back to ffmpeg: %s", e)
+        return decode_audio_ffmpeg(input_path)
     except Exception as e:
-        print(f"All conversion methods failed: {e}")
+        logger.error("All decoding methods failed: %s", e)
         raise Exception(f"Error converting audio: {e}")
 
-def analyze_voice_similarity(audio_file1_path: str, audio_file2_path: str) -> dict:
+def decode_audio_pair(input1: str, input2: str, executor: ThreadPoolExecutor = None) -> tuple:
+    """
+    Decode two inputs. With PyAV both are decoded in-process side by side;
+    otherwise a single ffmpeg invocation handles both (one process start
+    instead of two), the first output on stdout and the second on an extra
+    pipe. Falls back to per-file decode_audio on failure. PyAV decodes run
+    on `executor` if given (else the shared EXECUTOR).
+    """
+    if av is not None:
+        return tuple((executor or EXECUTOR).map(decode_audio, (input1, input2)))
+
     try:
-        print(f"Processing audio files: {audio_file1_path}, {audio_file2_path}")
+        if not FFMPEG_BIN or not os.path.exists(FFMPEG_BIN):
+            raise RuntimeError("bundled ffmpeg not found")
+
+        logger.debug("Decoding %s and %s using ffmpeg", input1, input2)
+
+        read_fd, write_fd = os.pipe()
+        cmd = [
+            FFMPEG_BIN,
+            "-hide_banner", "-loglevel", "error",
+            "-i", input1,
+            "-i", input2,
+            "-map", "0:a:0", *FFMPEG_PCM_OPTS, "pipe:1",
+            "-map", "1:a:0", *FFMPEG_PCM_OPTS, f"pipe:{write_fd}",
+        ]
+        try:
+            proc = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                pass_fds=(write_fd,),
+            )
+        except BaseException:
+            os.close(read_fd)  # nothing will read it now
+            raise
+        finally:
+            os.close(write_fd)
+
+        # Drain the second pipe on its own thread; ffmpeg interleaves both
+        # outputs and would block once either pipe buffer fills up.
+        second = {}
+        with os.fdopen(read_fd, "rb") as pipe2:
+            reader = threading.Thread(target=lambda: second.setdefault("data", pipe2.read()))
+            reader.start()
+            stdout, stderr = proc.communicate()
+            reader.join()
+
+        if proc.returncode != 0:
+            logger.warning("ffmpeg stderr: %s", stderr.decode(errors="replace"))
+            raise RuntimeError("ffmpeg failed")
 
-        print("Preprocessing audio file 1...")
-        wav1 = preprocess_wav(audio_file1_path)
-        print(f"Audio 1 shape: {wav1.shape}")
+        wavs = pcm16_to_float32(stdout), pcm16_to_float32(second.get("data", b""))
+        logger.debug("ffmpeg pair decoding successful")
+        return wavs
+    except Exception as e:
+        logger.warning("ffmpeg pair decoding failed, falling back to per-file decoding: %s", e)
+        return decode_audio(input1), decode_audio(input2)
 
-        print("Preprocessing audio file 2...")
-        wav2 = preprocess_wav(audio_file2_path)
-        print(f"Audio 2 shape: {wav2.shape}")
+def evict_shm_cache(nbytes: int) -> None:
+    """
+    Unlink the least recently used tmpfs entries until `nbytes` more fit
+    while leaving SHM_CACHE_MIN_FREE of the filesystem free. Workers that
+    still map an unlinked file keep reading it until they drop it.
+    """
+    st = os.statvfs(SHM_CACHE_DIR)
+    shortfall = nbytes + SHM_CACHE_MIN_FREE * st.f_blocks * st.f_frsize - st.f_bavail * st.f_frsize
+    if shortfall <= 0:
+        return
+    entries = []
+    with os.scandir(SHM_CACHE_DIR) as it:
+        for entry in it:
+            if not entry.name.endswith(".f32"):
+                continue  # another worker's in-flight write
+            try:
+                st_entry = entry.stat()
+            except OSError:
+                continue  # removed by another worker meanwhile
+            entries.append((st_entry.st_mtime, st_entry.st_size, entry.path))
+    for _, size, path in sorted(entries):
+        if shortfall <= 0:
+            break
+        try:
+            os.unlink(path)
+            shortfall -= size
+        except OSError:
+            pass
 
-        print("Extracting embeddings...")
-        embed1 = encoder.embed_utterance(wav1)
-        embed2 = encoder.embed_utterance(wav2)
+class SharedWavCache(LRUCache):
+    """
+    Preprocessed-wav cache: this worker's LRU backed by the shared tmpfs
+    tier under SHM_CACHE_DIR (memory-mapped, read-only).
+    """
 
-        similarity = float(
-            np.dot(embed1, embed2) / (np.linalg.norm(embed1) * np.linalg.norm(embed2))
-        )
+    def get(self, key: str):
+        wav = super().get(key)
+        if wav is not None or not SHM_CACHE_DIR:
+            return wav
+        path = os.path.join(SHM_CACHE_DIR, f"{key}.f32")
+        try:
+            wav = np.memmap(path, dtype=np.float32, mode="r")
+            os.utime(path)  # mtime marks recency for eviction (atime is unreliable under relatime)
+        except (OSError, ValueError):
+            return None
+        super().put(key, wav)
+        return wav
+
+    def put(self, key: str, wav: np.ndarray) -> None:
+        super().put(key, wav)
+        if not SHM_CACHE_DIR:
+            return
+        path = os.path.join(SHM_CACHE_DIR, f"{key}.f32")
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            evict_shm_cache(wav.nbytes)
+            np.asarray(wav, dtype=np.float32).tofile(tmp_path)
+            os.replace(tmp_path, path)  # atomic, so other workers never map a partial file
+            # Hold the shared mapping rather than a private copy
+            super().put(key, np.memmap(path, dtype=np.float32, mode="r"))
+        except (OSError, ValueError) as e:
+            logger.warning("Could not share preprocessed wav %s: %s", key[:12], e)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+embed_cache = EmbeddingCache("api")
+wav_cache = SharedWavCache(voice_core.WAV_CACHE_SIZE)
+
+def preprocess_source(source) -> np.ndarray:
+    """
+    preprocess_wav for either a file path or an already decoded 16 kHz
+    mono array.
+    """
+    if isinstance(source, np.ndarray):
+        return preprocess_wav(source, source_sr=16000)
+    return preprocess_wav(source)
+
+def get_embeddings(sources: list, keys: list = None, executor: ThreadPoolExecutor = None) -> list:
+    """
+    voice_core.get_embeddings for file paths or decoded 16 kHz arrays
+    (decoded arrays need their `keys`), with the tmpfs-backed wav cache.
+    """
+    return voice_core.get_embeddings(
+        sources, embed_cache, keys, preprocess=preprocess_source, wavs=wav_cache, executor=executor
+    )
 
-        threshold = 0.70
-        is_same_person = similarity >= threshold
+def analyze_voice_similarity(source1, source2, keys: list = None) -> dict:
+    try:
+        logger.debug("Embedding audio files...")
+        embed1, embed2 = get_embeddings([source1, source2], keys)
+
+        score = similarity(embed1, embed2)
+
+        threshold = SIMILARITY_THRESHOLD
+        is_same_person = score >= threshold
         result = "SAME PERSON" if is_same_person else "DIFFERENT PEOPLE"
 
-        print(f"Similarity score: {similarity}")
+        logger.debug("Similarity score: %s", score)
 
         return {
-            "similarity_score": similarity,
+            "similarity_score": score,
             "is_same_person": bool(is_same_person),
             "conclusion": result,
             "threshold": threshold,
         }
     except Exception as e:
-        print(f"Error in analyze_voice_similarity: {e}")
+        logger.error("Error in analyze_voice_similarity: %s", e)
         raise Exception(f"Error processing audio files: {e}")
 
+def prepare_sources(paths: list, digests: list, executor: ThreadPoolExecutor = None) -> list:
+    """
+    Turn downloaded files into inputs for get_embeddings. Clips whose
+    embedding or preprocessed wav is already cached skip decoding entirely,
+    and files libsndfile can read go straight to preprocess_wav. Everything
+    else is decoded into memory, on `executor` if given (else the shared
+    EXECUTOR).
+    """
+    needs_decode = [
+        embed_cache.get(digest) is None
+        and wav_cache.get(digest) is None
+        and get_audio_format(path) != "wav"
+        and not is_natively_decodable(path)
+        for path, digest in zip(paths, digests)
+    ]
+
+    if len(paths) == 2 and all(needs_decode):
+        return list(decode_audio_pair(*paths, executor=executor))
+
+    sources = list(paths)
+    to_decode = [i for i, needed in enumerate(needs_decode) if needed]
+    decoded = (executor or EXECUTOR).map(decode_audio, [paths[i] for i in to_decode])
+    for i, wav in zip(to_decode, decoded):
+        sources[i] = wav
+    return sources
+
+def peak_rss_mb() -> int:
+    """
+    Peak resident set size of this worker in MB: one getrusage() call, no
+    /proc parsing. (An RSS before/after delta is meaningless once requests
+    share the process.)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss >> 10  # KB on Linux
+
+def compare_audio_files(temp1_path: str, temp2_path: str, digest1: str, digest2: str) -> dict:
+    """
+    Decode (where needed) and compare two audio files already on disk,
+    given the SHA-256 digests of their raw bytes. The input files are left
+    to the caller to remove.
+    """
+    start_time = time.time()
+
+    sources = prepare_sources([temp1_path, temp2_path], [digest1, digest2])
+    result = analyze_voice_similarity(sources[0], sources[1], [digest1, digest2])
+
+    exec_time = time.time() - start_time
+    result.update(
+        {
+            "execution_time_seconds": round(exec_time, 4),
+            "memory_usage_mb": peak_rss_mb(),
+            "status": "success",
+        }
+    )
+    return result
+
+def save_stream(stream, out_path: str, length: int) -> str:
+    """
+    Copy exactly `length` bytes from a stream to disk in 1 MB chunks,
+    hashing them on the way. Returns the SHA-256 hex digest.
+    """
+    h = hashlib.sha256()
+    remaining = length
+    with open(out_path, "wb") as f:
+        while remaining > 0:
+            chunk = stream.read(min(remaining, 1 << 20))
+            if not chunk:
+                raise BadRequest("Request body is shorter than the declared audio lengths")
+            h.update(chunk)
+            f.write(chunk)
+            remaining -= len(chunk)
+    return h.hexdigest()
+
 @app.route("/compare_voices", methods=["POST"])
 def compare_voices():
     try:
         data = request.get_json()
-        if not data or "audio1_url" not in data or "audio2_url" not in data:
+        if not isinstance(data, dict) or "audio1_url" not in data or "audio2_url" not in data:
             return jsonify({"error": "Both audio1_url and audio2_url are required in JSON request"}), 400
 
         audio1_url = data["audio1_url"]
@@ -207,64 +540,202 @@ def compare_voices():
         if not (allowed_file(fn1) and allowed_file(fn2)):
             return jsonify({"error": f'Invalid file type in URLs. Allowed types: {", ".join(ALLOWED_EXTENSIONS)}'}), 400
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{fn1}") as t1:
-            temp1_path = t1.name
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{fn2}") as t2:
-            temp2_path = t2.name
-
-        download_audio_from_url(audio1_url, temp1_path)
-        download_audio_from_url(audio2_url, temp2_path)
+        # One scratch directory per request; removed wholesale afterwards
+        workdir = tempfile.mkdtemp(prefix="vsm_")
+        try:
+            temp1_path = os.path.join(workdir, f"a.{get_audio_format(fn1)}")
+            temp2_path = os.path.join(workdir, f"b.{get_audio_format(fn2)}")
+
+            # Both downloads are network-bound: run them side by side
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                (_, digest1), (_, digest2) = pool.map(
+                    download_audio_from_url, (audio1_url, audio2_url), (temp1_path, temp2_path)
+                )
+            result = compare_audio_files(temp1_path, temp2_path, digest1, digest2)
+            return jsonify(result)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
 
-        start_time = time.time()
-        process = psutil.Process(os.getpid())
-        initial_mem = process.memory_info().rss / (1024 * 1024)
+    except Exception as e:
+        logger.exception("Error in compare_voices endpoint: %s", e)
+        return jsonify({"error": str(e), "status": "error"}), 500
 
-        converted_files = []
-        final_path1 = temp1_path
-        final_path2 = temp2_path
+@app.route("/compare_voices_raw", methods=["POST"])
+def compare_voices_raw():
+    """
+    Compare two clips sent back to back as the raw request body. Bypasses
+    the multipart form parser: the body is streamed straight to disk.
+    """
+    try:
+        try:
+            len1 = int(request.headers["X-Audio1-Length"])
+            len2 = int(request.headers["X-Audio2-Length"])
+        except (KeyError, ValueError):
+            return jsonify({"error": "X-Audio1-Length and X-Audio2-Length headers are required"}), 400
+        if len1 <= 0 or len2 <= 0:
+            return jsonify({"error": "Audio lengths must be positive"}), 400
+        # Reject before anything is written to disk
+        if len1 + len2 > MAX_CONTENT_LENGTH:
+            return jsonify({"error": f"Audio exceeds {MAX_CONTENT_LENGTH >> 20} MB"}), 413
+        if len1 + len2 != request.content_length:
+            return jsonify({"error": "X-Audio1-Length + X-Audio2-Length must equal the body's Content-Length"}), 400
+
+        fn1 = secure_filename(request.headers.get("X-Audio1-Filename", ""))
+        fn2 = secure_filename(request.headers.get("X-Audio2-Filename", ""))
+        if not (allowed_file(fn1) and allowed_file(fn2)):
+            return jsonify({"error": f'Invalid file type in filenames. Allowed types: {", ".join(ALLOWED_EXTENSIONS)}'}), 400
 
+        workdir = tempfile.mkdtemp(prefix="vsm_")
         try:
-            fmt1 = get_audio_format(temp1_path)
-            if fmt1 != "wav":
-                wav1_path = temp1_path.replace(f".{fmt1}", ".wav")
-                convert_to_wav(temp1_path, wav1_path)
-                converted_files.append(wav1_path)
-                final_path1 = wav1_path
-
-            fmt2 = get_audio_format(temp2_path)
-            if fmt2 != "wav":
-                wav2_path = temp2_path.replace(f".{fmt2}", ".wav")
-                convert_to_wav(temp2_path, wav2_path)
-                converted_files.append(wav2_path)
-                final_path2 = wav2_path
-
-            result = analyze_voice_similarity(final_path1, final_path2)
-
-            exec_time = time.time() - start_time
-            final_mem = process.memory_info().rss / (1024 * 1024)
-            mem_used = final_mem - initial_mem
-
-            result.update(
-                {
-                    "execution_time_seconds": round(exec_time, 4),
-                    "memory_usage_mb": round(mem_used, 2),
-                    "status": "success",
-                }
-            )
+            temp1_path = os.path.join(workdir, f"a.{get_audio_format(fn1)}")
+            temp2_path = os.path.join(workdir, f"b.{get_audio_format(fn2)}")
+            digest1 = save_stream(request.stream, temp1_path, len1)
+            digest2 = save_stream(request.stream, temp2_path, len2)
+            result = compare_audio_files(temp1_path, temp2_path, digest1, digest2)
             return jsonify(result)
         finally:
-            # cleanup
-            for p in [temp1_path, temp2_path, *converted_files]:
-                try:
-                    if p and os.path.exists(p):
-                        os.unlink(p)
-                except OSError:
-                    pass
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    except HTTPException:
+        raise  # client errors from reading the body (400, 413) keep their status
+    except Exception as e:
+        logger.exception("Error in compare_voices_raw endpoint: %s", e)
+        return jsonify({"error": str(e), "status": "error"}), 500
+
+def url_list_error(urls: list):
+    """Validation message for a list of clip URLs, or None if they are all usable."""
+    if not all(isinstance(u, str) and is_valid_url(u) for u in urls):
+        return "Invalid URLs provided"
+    if not all(allowed_file(get_filename_from_url(u)) for u in urls):
+        return f'Invalid file type in URLs. Allowed types: {", ".join(ALLOWED_EXTENSIONS)}'
+    return None
+
+def download_and_embed(urls: list) -> tuple:
+    """
+    Download, decode and embed a list of clips on a pool of their own: up
+    to MAX_CANDIDATES + 1 jobs would otherwise queue on the shared EXECUTOR
+    ahead of every other request's work. A URL listed more than once is
+    fetched and embedded once. Returns (embeddings in the order of `urls`,
+    seconds spent after the downloads).
+    """
+    unique = list(dict.fromkeys(urls))
+    workdir = tempfile.mkdtemp(prefix="vsm_")
+    try:
+        temp_paths = [
+            os.path.join(workdir, f"{i}.{get_audio_format(get_filename_from_url(u))}")
+            for i, u in enumerate(unique)
+        ]
+        with ThreadPoolExecutor(max_workers=min(FANOUT_WORKERS, len(unique))) as pool:
+            digests = [d for _, d in pool.map(download_audio_from_url, unique, temp_paths)]
+
+            start_time = time.time()
+            sources = prepare_sources(temp_paths, digests, executor=pool)
+            embeds = dict(zip(unique, get_embeddings(sources, digests, executor=pool)))
+        return [embeds[u] for u in urls], time.time() - start_time
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+@app.route("/compare_many", methods=["POST"])
+def compare_many():
+    """
+    Compare one source clip against many candidates. All embeddings come
+    from one batched encoder pass (or the cache), and the scores from a
+    single matrix-vector product.
+    """
+    try:
+        data = request.get_json()
+        if not isinstance(data, dict) or "source_url" not in data or not data.get("candidate_urls"):
+            return jsonify({"error": "source_url and a non-empty candidate_urls list are required in JSON request"}), 400
+
+        source_url = data["source_url"]
+        candidate_urls = data["candidate_urls"]
+        if not isinstance(candidate_urls, list) or len(candidate_urls) > MAX_CANDIDATES:
+            return jsonify({"error": f"candidate_urls must be a list of at most {MAX_CANDIDATES} URLs"}), 400
+
+        urls = [source_url, *candidate_urls]
+        error = url_list_error(urls)
+        if error:
+            return jsonify({"error": error}), 400
+
+        embeds, elapsed = download_and_embed(urls)
+
+        # Unit-norm embeddings: one (K, 256) @ (256,) matvec gives every
+        # candidate's cosine similarity to the source
+        src = embeds[0]
+        cand = np.stack(embeds[1:])
+        scores = np.clip(cand @ src, -1.0, 1.0)
+        matches = np.flatnonzero(scores >= SIMILARITY_THRESHOLD)
+
+        return jsonify(
+            {
+                "threshold": SIMILARITY_THRESHOLD,
+                "results": [
+                    {
+                        "url": url,
+                        "similarity_score": float(score),
+                        "is_same_person": bool(score >= SIMILARITY_THRESHOLD),
+                    }
+                    for url, score in zip(candidate_urls, scores)
+                ],
+                "matches": [candidate_urls[i] for i in matches],
+                "execution_time_seconds": round(elapsed, 4),
+                "status": "success",
+            }
+        )
+
+    except Exception as e:
+        logger.exception("Error in compare_many endpoint: %s", e)
+        return jsonify({"error": str(e), "status": "error"}), 500
+
+@app.route("/compare_voices_batch", methods=["POST"])
+def compare_voices_batch():
+    """
+    All-pairs comparison of N clips: the (N, 256) embedding matrix times
+    its transpose gives the full cosine similarity matrix in one SGEMM.
+    """
+    try:
+        data = request.get_json()
+        urls = data.get("urls") if isinstance(data, dict) else None
+        if not isinstance(urls, list) or not 2 <= len(urls) <= MAX_CANDIDATES:
+            return jsonify({"error": f"urls must be a list of 2 to {MAX_CANDIDATES} URLs"}), 400
+        error = url_list_error(urls)
+        if error:
+            return jsonify({"error": error}), 400
+        # A repeated URL would just be reported as its own copy's best match
+        if len(set(urls)) != len(urls):
+            return jsonify({"error": "urls must not contain duplicates"}), 400
+
+        embeds, elapsed = download_and_embed(urls)
+
+        # Rows are unit-norm, so E @ E.T is the cosine similarity matrix
+        E = np.stack(embeds).astype(np.float32, copy=False)
+        S = np.clip(E @ E.T, -1.0, 1.0)
+        # Best match per clip, ignoring the clip itself on the diagonal
+        np.fill_diagonal(S, -np.inf)
+        best = S.argmax(axis=1)
+        np.fill_diagonal(S, 1.0)
+
+        return jsonify(
+            {
+                "threshold": SIMILARITY_THRESHOLD,
+                "urls": urls,
+                "similarity_matrix": S.round(4).tolist(),
+                "best_matches": [
+                    {
+                        "url": url,
+                        "best_match": urls[j],
+                        "similarity_score": float(S[i, j]),
+                        "is_same_person": bool(S[i, j] >= SIMILARITY_THRESHOLD),
+                    }
+                    for i, (url, j) in enumerate(zip(urls, best))
+                ],
+                "execution_time_seconds": round(elapsed, 4),
+                "status": "success",
+            }
+        )
 
     except Exception as e:
-        print(f"Error in compare_voices endpoint: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in compare_voices_batch endpoint: %s", e)
         return jsonify({"error": str(e), "status": "error"}), 500
 
 @app.route("/health", methods=["GET"])
@@ -279,6 +750,9 @@ def home():
             "version": "2.1",
             "endpoints": {
                 "POST /compare_voices": "Compare two voice audio files from URLs",
+                "POST /compare_voices_raw": "Compare two voice audio files sent as the raw request body",
+                "POST /compare_many": "Compare a source voice URL against a list of candidate URLs",
+                "POST /compare_voices_batch": "All-pairs similarity matrix for a list of voice URLs",
                 "GET /health": "Health check",
                 "GET /": "API documentation",
             },
@@ -291,6 +765,35 @@ def home():
                     "audio2_url": "Second audio file URL (wav, mp3, m4a, flac, ogg, webm)",
                 },
             },
+            "compare_many_usage": {
+                "method": "POST",
+                "endpoint": "/compare_many",
+                "content_type": "application/json",
+                "parameters": {
+                    "source_url": "Reference audio file URL",
+                    "candidate_urls": f"List of up to {MAX_CANDIDATES} audio file URLs to score against the source",
+                },
+            },
+            "batch_usage": {
+                "method": "POST",
+                "endpoint": "/compare_voices_batch",
+                "content_type": "application/json",
+                "parameters": {
+                    "urls": f"List of 2 to {MAX_CANDIDATES} audio file URLs to compare with each other",
+                },
+            },
+            "raw_usage": {
+                "method": "POST",
+                "endpoint": "/compare_voices_raw",
+                "content_type": "application/octet-stream",
+                "body": "Bytes of audio 1 immediately followed by bytes of audio 2",
+                "headers": {
+                    "X-Audio1-Length": "Size of the first file in bytes",
+                    "X-Audio2-Length": "Size of the second file in bytes",
+                    "X-Audio1-Filename": "First file name, used for its extension",
+                    "X-Audio2-Filename": "Second file name, used for its extension",
+                },
+            },
         }
     )
 
@@ -298,10 +801,11 @@ def home():
 app = app
 
 if __name__ == "__main__":
+    # Development server only; production runs `gunicorn -c gunicorn_conf.py`
     # Helpful startup logs
     try:
         ver = subprocess.check_output([FFMPEG_BIN, "-version"], text=True).splitlines()[0]
-        print("Using ffmpeg:", ver, "at", FFMPEG_BIN)
+        logger.info("Using ffmpeg: %s at %s", ver, FFMPEG_BIN)
     except Exception as e:
-        print("ffmpeg not available at startup:", e)
+        logger.warning("ffmpeg not available at startup: %s", e)
     app.run(debug=False, host="0.0.0.0", port=5000)
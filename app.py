@@ -1,12 +1,20 @@
 import os
 import time
 import psutil
-import numpy as np
+import logging
 import gradio as gr
-from resemblyzer import VoiceEncoder, preprocess_wav
+from voice_core import EmbeddingCache, get_embeddings, similarity
 
-# Initialize the VoiceEncoder
-encoder = VoiceEncoder()
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+
+# psutil handle for the memory metric, created once rather than per analysis
+PROCESS = psutil.Process(os.getpid())
+
+# Embeddings cached by file contents (memory, spilled to disk)
+embed_cache = EmbeddingCache("gradio")
 
 def analyze_voice_similarity(audio_file1, audio_file2, progress=gr.Progress()):
     # Update progress for visual feedback
@@ -18,72 +26,33 @@ def analyze_voice_similarity(audio_file1, audio_file2, progress=gr.Progress()):
     
     start_time = time.time()  # Record start time
     
-    # Get current process information
-    process = psutil.Process(os.getpid())
-    
-    # Preprocess audio files
+    # Preprocess audio files and extract speaker embeddings (cached by file contents)
     try:
-        progress(0.2, desc="Processing first audio file...")
-        wav1 = preprocess_wav(audio_file1)
-        
-        progress(0.4, desc="Processing second audio file...")
-        wav2 = preprocess_wav(audio_file2)
+        progress(0.2, desc="Processing audio files...")
+        embed1, embed2 = get_embeddings([audio_file1, audio_file2], embed_cache)
     except Exception as e:
         return "", "", "", "", f"Error processing audio files: {str(e)}"
     
-    # Extract speaker embeddings
-    progress(0.6, desc="Extracting voice embeddings...")
-    embed1 = encoder.embed_utterance(wav1)
-    embed2 = encoder.embed_utterance(wav2)
-    
-    # Calculate cosine similarity between embeddings
+    # Calculate cosine similarity between the unit-norm embeddings
     progress(0.8, desc="Calculating similarity...")
-    similarity = np.dot(embed1, embed2) / (np.linalg.norm(embed1) * np.linalg.norm(embed2))
+    score = similarity(embed1, embed2)
     
     # Determine if voices are from the same source
-    result = "SAME PERSON" if similarity >= 0.80 else "DIFFERENT PEOPLE"
+    result = "SAME PERSON" if score >= 0.80 else "DIFFERENT PEOPLE"
     
     # Get memory usage
-    memory_usage = process.memory_info().rss / (1024 * 1024)  # in MB
+    memory_usage = PROCESS.memory_info().rss >> 20  # in MB
     
     # Calculate execution time
     execution_time = time.time() - start_time
     
     progress(1.0, desc="Analysis complete!")
     
-    # Format the HTML output for the results display
-    html_output = f"""
-    <div style="background-color: #f8f9fa; padding: 20px; border-radius: 10px; margin-top: 20px; box-shadow: 0 4px 6px rgba(0,0,0,0.1);">
-        <h2 style="color: #495057; margin-bottom: 15px;">Analysis Results</h2>
-        <div style="display: flex; justify-content: space-between; margin-bottom: 20px;">
-            <div style="flex: 1; padding-right: 10px;">
-                <h4 style="color: #6c757d; margin-bottom: 5px;">Similarity Score</h4>
-                <p style="font-size: 18px; font-weight: bold; color: #212529;">{similarity:.4f}</p>
-            </div>
-            <div style="flex: 1; padding-left: 10px;">
-                <h4 style="color: #6c757d; margin-bottom: 5px;">Conclusion</h4>
-                <p style="font-size: 18px; font-weight: bold; color: {'#28a745' if similarity >= 0.80 else '#dc3545'};">{result}</p>
-            </div>
-        </div>
-        <h3 style="color: #495057; margin-bottom: 15px;">Performance Metrics</h3>
-        <div style="display: flex; justify-content: space-between;">
-            <div style="flex: 1; padding-right: 10px;">
-                <h4 style="color: #6c757d; margin-bottom: 5px;">Memory Usage</h4>
-                <p style="font-size: 16px; color: #212529;">{memory_usage:.2f} MB</p>
-            </div>
-            <div style="flex: 1; padding-left: 10px;">
-                <h4 style="color: #6c757d; margin-bottom: 5px;">Execution Time</h4>
-                <p style="font-size: 16px; color: #212529;">{execution_time:.4f} seconds</p>
-            </div>
-        </div>
-    </div>
-    """
-    
-    # Return the individual values and the HTML display
+    # Return the individual values for the result textboxes
     return (
-        f"{similarity:.4f}",
+        f"{score:.4f}",
         result, 
-        f"{memory_usage:.2f} MB", 
+        f"{memory_usage} MB", 
         f"{execution_time:.4f} seconds",
         ""  # No error
     )
@@ -1,83 +1,153 @@
 import os
 import time
-import psutil
+import io
+import hashlib
+import logging
+import resource
 import numpy as np
+import voice_core
+from voice_core import similarity
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-from resemblyzer import VoiceEncoder, preprocess_wav
+from resemblyzer import preprocess_wav
+import shutil
 import tempfile
 import librosa
 import soundfile as sf
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
+# Optional C-level JSON serializer, several times faster than the stdlib json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (always compact)."""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+# Lazy %-style logging: debug messages are never formatted unless
+# LOG_LEVEL=DEBUG (use LOG_LEVEL=WARNING in production)
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s %(levelname)s %(name)s: %(message)s'
+)
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
+if orjson is not None:
+    app.json = ORJSONProvider(app)
+app.json.compact = True  # no pretty-printing, even in debug
 
 # Enable CORS for all routes
-CORS(app, origins=['*'], methods=['GET', 'POST'], allow_headers=['Content-Type'])
+# (max_age lets browsers cache the OPTIONS preflight for a day)
+CORS(app, origins=['*'], methods=['GET', 'POST'], allow_headers=['Content-Type'], max_age=86400)
 
 # Configuration
 ALLOWED_EXTENSIONS = {'wav', 'mp3', 'm4a', 'flac', 'ogg', 'webm'}
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
 
-# Initialize the VoiceEncoder
-encoder = VoiceEncoder()
+# Shared HTTP session so repeat downloads from the same host reuse connections
+HTTP = requests.Session()
+HTTP.headers.update({
+    'User-Agent': 'VoiceSimilarityMatcher/1.0',
+    'Accept': 'audio/*,*/*;q=0.9'
+})
 
 def allowed_file(filename):
     """Check if the uploaded file has an allowed extension."""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def convert_to_wav(input_path, output_path):
-    """Convert audio file to WAV format using librosa."""
+# Formats libsndfile decodes natively; everything else goes through librosa
+SNDFILE_FORMATS = {'wav', 'flac', 'ogg'}
+
+def load_audio(file_path):
+    """Decode an audio file or in-memory buffer to a mono float32 array at its native sample rate."""
     try:
-        print(f"Converting {input_path} to {output_path}")
-        
-        # Load audio file with librosa
-        audio_data, sample_rate = librosa.load(input_path, sr=16000, mono=True)
-        
-        # Save as WAV file
-        sf.write(output_path, audio_data, sample_rate, subtype='PCM_16')
-        
-        print(f"Conversion successful: {output_path}")
-        return output_path
-        
+        if isinstance(file_path, io.BytesIO) or get_audio_format(file_path) in SNDFILE_FORMATS:
+            try:
+                audio, sample_rate = sf.read(file_path, dtype='float32', always_2d=True)
+                return audio.mean(axis=1), sample_rate
+            except Exception as e:
+                # Buffers were probed with sf.info before being kept in
+                # memory, and audioread can only open files
+                if isinstance(file_path, io.BytesIO):
+                    raise
+                # e.g. a codec this libsndfile build lacks, or a mislabelled
+                # extension: let librosa/audioread try
+                logger.warning("soundfile could not decode %s, falling back to librosa: %s", file_path, e)
+        return librosa.load(file_path, sr=None, mono=True, dtype=np.float32)
     except Exception as e:
-        raise Exception(f"Error converting audio: {str(e)}")
+        raise Exception(f"Error decoding audio: {str(e)}")
+
+def preprocess_file(file_path):
+    """Decode once and hand the array to preprocess_wav, which resamples to 16 kHz."""
+    audio, sample_rate = load_audio(file_path)
+    return preprocess_wav(audio, source_sr=sample_rate)
 
 def get_audio_format(file_path):
     """Detect audio format from file extension."""
     _, ext = os.path.splitext(file_path.lower())
     return ext[1:] if ext else 'unknown'
 
-def download_audio_from_url(url, output_path):
-    """Download audio file from URL and save to local path."""
+def download_audio_from_url(url):
+    """Download an audio file into memory; returns (BytesIO buffer, sha256 hex digest)."""
     try:
-        print(f"Downloading audio from URL: {url}")
-        
-        # Set headers to mimic a browser request
-        headers = {
-            'User-Agent': 'VoiceSimilarityMatcher/1.0',
-            'Accept': 'audio/*,*/*;q=0.9'
-        }
-        
-        # Download the file
-        response = requests.get(url, headers=headers, timeout=30, stream=True)
-        response.raise_for_status()
+        logger.debug("Downloading audio from URL: %s", url)
         
-        # Save to temporary file
-        with open(output_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
+        # Download the file over the shared session
+        # (the with block hands the connection back to the pool even on errors)
+        with HTTP.get(url, timeout=30, stream=True) as response:
+            response.raise_for_status()
+            
+            # Reject up front when the server announces an oversized body
+            if int(response.headers.get('Content-Length') or 0) > MAX_CONTENT_LENGTH:
+                raise Exception(f"File exceeds {MAX_CONTENT_LENGTH >> 20} MB")
+            
+            # Buffer in memory (at most MAX_CONTENT_LENGTH), hashing the bytes
+            # and enforcing the size cap as they arrive
+            buf = io.BytesIO()
+            h = hashlib.sha256()
+            total = 0
+            # (1 MB reads straight from urllib3 instead of 8 KB iter_content chunks)
+            response.raw.decode_content = True
+            while chunk := response.raw.read(1 << 20):
+                total += len(chunk)
+                if total > MAX_CONTENT_LENGTH:
+                    raise Exception(f"File exceeds {MAX_CONTENT_LENGTH >> 20} MB")
+                h.update(chunk)
+                buf.write(chunk)
         
-        print(f"Successfully downloaded audio to: {output_path}")
-        return output_path
+        buf.seek(0)
+        logger.debug("Successfully downloaded %s bytes from: %s", total, url)
+        return buf, h.hexdigest()
         
     except requests.exceptions.RequestException as e:
         raise Exception(f"Failed to download audio from URL: {str(e)}")
     except Exception as e:
         raise Exception(f"Error downloading audio: {str(e)}")
 
+def in_memory_or_spill(buf, spill_path):
+    """Keep a downloaded clip in memory when libsndfile can decode it; otherwise write it to spill_path."""
+    try:
+        sf.info(buf)  # header-only probe
+        buf.seek(0)
+        return buf
+    except Exception:
+        # mp3/m4a/webm go through librosa's audioread backend, which needs a file
+        with open(spill_path, 'wb') as f:
+            f.write(buf.getbuffer())
+        return spill_path
+
 def get_filename_from_url(url):
     """Extract filename from URL."""
     parsed_url = urlparse(url)
@@ -95,42 +165,39 @@ def is_valid_url(url):
     except:
         return False
 
-def analyze_voice_similarity(audio_file1_path, audio_file2_path):
+# Embeddings of this app's decode path, cached by content hash
+embed_cache = voice_core.EmbeddingCache('flask')
+
+def get_embeddings(file_paths, keys=None):
+    """Return speaker embeddings for several files or buffers, cached by content hash."""
+    return voice_core.get_embeddings(file_paths, embed_cache, keys, preprocess=preprocess_file)
+
+def analyze_voice_similarity(audio_file1_path, audio_file2_path, keys=None):
     """Analyze voice similarity between two audio files."""
     try:
-        print(f"Processing audio files: {audio_file1_path}, {audio_file2_path}")
-        
-        # Preprocess audio files
-        print("Preprocessing audio file 1...")
-        wav1 = preprocess_wav(audio_file1_path)
-        print(f"Audio 1 shape: {wav1.shape}")
-        
-        print("Preprocessing audio file 2...")
-        wav2 = preprocess_wav(audio_file2_path)
-        print(f"Audio 2 shape: {wav2.shape}")
+        logger.debug("Processing audio files: %s, %s", audio_file1_path, audio_file2_path)
         
-        # Extract speaker embeddings
-        print("Extracting embeddings...")
-        embed1 = encoder.embed_utterance(wav1)
-        embed2 = encoder.embed_utterance(wav2)
+        # Extract speaker embeddings in one batch (cached by file contents)
+        logger.debug("Embedding audio files...")
+        embed1, embed2 = get_embeddings([audio_file1_path, audio_file2_path], keys)
         
-        # Calculate cosine similarity between embeddings
-        similarity = np.dot(embed1, embed2) / (np.linalg.norm(embed1) * np.linalg.norm(embed2))
+        # Cosine similarity of the unit-norm embeddings
+        score = similarity(embed1, embed2)
         
         # Determine if voices are from the same source
-        is_same_person = similarity >= 0.80
+        is_same_person = score >= 0.80
         result = "SAME PERSON" if is_same_person else "DIFFERENT PEOPLE"
         
-        print(f"Similarity score: {similarity}")
+        logger.debug("Similarity score: %s", score)
         
         return {
-            'similarity_score': float(similarity),
+            'similarity_score': score,
             'is_same_person': bool(is_same_person),
             'conclusion': result,
             'threshold': 0.80
         }
     except Exception as e:
-        print(f"Error in analyze_voice_similarity: {str(e)}")
+        logger.error("Error in analyze_voice_similarity: %s", e)
         raise Exception(f"Error processing audio files: {str(e)}")
 
 @app.route('/compare_voices', methods=['POST'])
@@ -164,80 +231,51 @@ def compare_voices():
                 'error': f'Invalid file type in URLs. Allowed types: {", ".join(ALLOWED_EXTENSIONS)}'
             }), 400
         
-        # Create temporary files for downloaded audio
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f'_{filename1}') as temp1:
-            temp1_path = temp1.name
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f'_{filename2}') as temp2:
-            temp2_path = temp2.name
-        
-        # Download audio files from URLs
-        download_audio_from_url(audio1_url, temp1_path)
-        download_audio_from_url(audio2_url, temp2_path)
-        
-        # Record start time for performance metrics
-        start_time = time.time()
-        
-        # Get current process information for memory usage
-        process = psutil.Process(os.getpid())
-        initial_memory = process.memory_info().rss / (1024 * 1024)  # in MB
-        
+        # One scratch directory per request for clips that can't be decoded
+        # from memory, removed wholesale afterwards
+        workdir = tempfile.mkdtemp(prefix='vsm_')
         try:
-            # Convert audio files to WAV if needed
-            converted_files = []
+            temp1_path = os.path.join(workdir, f'a.{get_audio_format(filename1)}')
+            temp2_path = os.path.join(workdir, f'b.{get_audio_format(filename2)}')
+            
+            # Download both audio files side by side (pure network wait)
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                (buf1, digest1), (buf2, digest2) = pool.map(
+                    download_audio_from_url, (audio1_url, audio2_url)
+                )
             
-            # Check and convert first audio file
-            audio_format1 = get_audio_format(temp1_path)
-            if audio_format1 != 'wav':
-                wav1_path = temp1_path.replace(f'.{audio_format1}', '.wav')
-                convert_to_wav(temp1_path, wav1_path)
-                converted_files.append(wav1_path)
-                final_path1 = wav1_path
-            else:
-                final_path1 = temp1_path
+            # Record start time for performance metrics
+            start_time = time.time()
             
-            # Check and convert second audio file
-            audio_format2 = get_audio_format(temp2_path)
-            if audio_format2 != 'wav':
-                wav2_path = temp2_path.replace(f'.{audio_format2}', '.wav')
-                convert_to_wav(temp2_path, wav2_path)
-                converted_files.append(wav2_path)
-                final_path2 = wav2_path
-            else:
-                final_path2 = temp2_path
+            # wav/flac/ogg are decoded straight from the download buffer; the
+            # rest is written to the scratch dir for librosa
+            source1 = in_memory_or_spill(buf1, temp1_path)
+            source2 = in_memory_or_spill(buf2, temp2_path)
             
-            # Analyze voice similarity with converted files
-            result = analyze_voice_similarity(final_path1, final_path2)
+            # Analyze voice similarity; each clip is decoded straight into
+            # preprocessing, and not at all when its hash is already cached
+            result = analyze_voice_similarity(source1, source2, [digest1, digest2])
             
             # Calculate performance metrics
             execution_time = time.time() - start_time
-            final_memory = process.memory_info().rss / (1024 * 1024)  # in MB
-            memory_usage = final_memory - initial_memory
             
             # Add performance metrics to result
             result.update({
                 'execution_time_seconds': round(execution_time, 4),
-                'memory_usage_mb': round(memory_usage, 2),
+                # Peak RSS of this worker (one getrusage call; ru_maxrss is
+                # in KB on Linux)
+                'memory_usage_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss >> 10,
                 'status': 'success'
             })
             
             return jsonify(result)
             
         finally:
-            # Clean up temporary files
-            try:
-                os.unlink(temp1_path)
-                os.unlink(temp2_path)
-                # Clean up converted files
-                for converted_file in converted_files:
-                    os.unlink(converted_file)
-            except OSError:
-                pass  # Files might already be deleted
+            # Clean up spilled files
+            shutil.rmtree(workdir, ignore_errors=True)
     
     except Exception as e:
-        print(f"Error in compare_voices endpoint: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in compare_voices endpoint: %s", e)
         return jsonify({
             'error': str(e),
             'status': 'error'
@@ -280,7 +318,7 @@ def home():
                 'conclusion': 'Human readable result',
                 'threshold': 'Similarity threshold used (0.80)',
                 'execution_time_seconds': 'Processing time',
-                'memory_usage_mb': 'Memory used during processing',
+                'memory_usage_mb': 'Peak memory of the worker process in MB',
                 'status': 'success/error'
             }
         }
@@ -290,5 +328,9 @@ def home():
 app = app
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5003)
+    # Development server only. For serving, run under gunicorn with a
+    # preloaded model, e.g.:
+    #   gunicorn --preload -w 2 -k gthread --threads 4 -b 0.0.0.0:5003 flask-app:app
+    # (debug=True would also start the reloader, loading the encoder twice)
+    app.run(debug=False, host='0.0.0.0', port=5003)
 
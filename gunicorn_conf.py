@@ -0,0 +1,56 @@
+"""
+Gunicorn settings for the Flask API (api/flask_app.py).
+
+    gunicorn -c gunicorn_conf.py
+
+APP_MODULE selects another entry point, e.g. APP_MODULE=flask-app:app for
+the standalone flask-app.py (gunicorn imports it by file name, so the
+hyphen is fine).
+
+Set GPU=1 on GPU hosts (the default is CPU). On CPU, preload_app builds
+the VoiceEncoder (and runs its warmup) once in the master before forking,
+so workers share the torch/model pages copy-on-write instead of each
+loading their own copy. A CUDA context does not survive fork(), so on GPU
+a single worker loads the model itself and serves requests on more threads.
+
+The encoder runs in FP32 unless ENCODER_LOW_PRECISION=1 (int8 dynamic
+quantization on CPU, FP16 on GPU). It is off by default because it changes
+the scores; on CPU hosts set it once tests/test_voice_core.py shows the
+drift is acceptable for your threshold.
+"""
+import os
+
+wsgi_app = os.environ.get("APP_MODULE", "api.flask_app:app")
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# GPU=1 selects the GPU layout. The same variable tells voice_core which
+# device to load the encoder on, so the worker layout and the device can't
+# disagree (and the master never has to touch CUDA to decide).
+GPU = os.environ.get("GPU", "0") == "1"
+os.environ["GPU"] = "1" if GPU else "0"
+CPUS = os.cpu_count() or 1
+
+if GPU:
+    workers = 1
+    threads = int(os.environ.get("GUNICORN_THREADS", 16))
+    preload_app = False
+else:
+    workers = int(os.environ.get("WEB_CONCURRENCY", max(2, CPUS)))
+    threads = int(os.environ.get("GUNICORN_THREADS", 4))
+    preload_app = True
+worker_class = "gthread"
+# voice_core sizes its preprocessing pool from this
+os.environ["GUNICORN_THREADS"] = str(threads)
+
+# Downloads + decode + embedding can take a while for long clips
+timeout = 120
+# Hold idle client connections open so back-to-back calls from one client
+# reuse the TCP/TLS session (gthread workers only)
+keepalive = 30
+
+def post_fork(server, worker):
+    # The preloaded app sized torch's intra-op pool to every core; split the
+    # cores between workers so they don't oversubscribe each other
+    if not GPU:
+        import torch
+        torch.set_num_threads(max(1, CPUS // workers))
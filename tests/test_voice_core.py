@@ -0,0 +1,100 @@
+"""
+The batched embedding path in voice_core must match resemblyzer's own
+per-utterance path. Run with: python -m pytest tests
+"""
+import copy
+import os
+import sys
+
+import pytest
+
+# Full-precision encoder and no warmup: the comparisons below are against
+# resemblyzer's FP32 reference path
+os.environ["WARMUP"] = "0"
+os.environ["ENCODER_LOW_PRECISION"] = "0"
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("torch")
+pytest.importorskip("resemblyzer")
+from resemblyzer.audio import wav_to_mel_spectrogram
+from resemblyzer.hparams import sampling_rate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import voice_core
+
+def synthetic_wav(seconds: float, seed: int) -> np.ndarray:
+    """A few harmonics plus noise: deterministic, and not silence."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sampling_rate)) / sampling_rate
+    f0 = rng.uniform(100, 250)
+    wav = sum(np.sin(2 * np.pi * f0 * k * t) / k for k in range(1, 6))
+    wav = wav + 0.05 * rng.standard_normal(len(t))
+    return (0.3 * wav / np.abs(wav).max()).astype(np.float32)
+
+def test_wav_to_mel_matches_resemblyzer():
+    wav = synthetic_wav(2.0, seed=0)
+    ours = voice_core.wav_to_mel(wav)
+    ref = wav_to_mel_spectrogram(wav)
+    assert ours.shape == ref.shape
+    assert ours.dtype == np.float32
+    np.testing.assert_allclose(ours, ref, rtol=1e-3, atol=1e-6)
+
+@pytest.mark.parametrize("seconds", [0.5, 3.0, 7.3])
+def test_embed_utterance_batch_single_matches_embed_utterance(seconds):
+    wav = synthetic_wav(seconds, seed=1)
+    ours = voice_core.embed_utterance_batch([wav])[0]
+    ref = voice_core.encoder.embed_utterance(wav)
+    np.testing.assert_allclose(ours, ref, atol=1e-4)
+
+def test_embed_utterance_batch_is_independent_of_batching(monkeypatch):
+    wavs = [synthetic_wav(s, seed=i) for i, s in enumerate([1.0, 4.5, 2.2])]
+    refs = [voice_core.encoder.embed_utterance(w) for w in wavs]
+    # Force several forward passes so the EMBED_BATCH_SIZE slicing is covered
+    monkeypatch.setattr(voice_core, "EMBED_BATCH_SIZE", 3)
+    for ours, ref in zip(voice_core.embed_utterance_batch(wavs), refs):
+        np.testing.assert_allclose(ours, ref, atol=1e-4)
+
+def test_similarity_is_clamped_dot():
+    a, b = voice_core.embed_utterance_batch([synthetic_wav(2.0, seed=3), synthetic_wav(2.0, seed=4)])
+    assert voice_core.similarity(a, b) == pytest.approx(float(np.dot(a, b)), abs=1e-6)
+    assert voice_core.similarity(a, a) <= 1.0
+
+# Largest similarity drift accepted from ENCODER_LOW_PRECISION=1 (FP16 on
+# GPU, int8 on CPU)
+LOW_PRECISION_TOLERANCE = 1e-2
+
+def test_low_precision_similarity_matches_fp32(monkeypatch):
+    wavs = [synthetic_wav(3.0, seed=5), synthetic_wav(3.0, seed=6)]
+    sim_fp32 = voice_core.similarity(*voice_core.embed_utterance_batch(wavs))
+
+    low_model, low_dtype = voice_core.to_low_precision(copy.deepcopy(voice_core.encoder))
+    monkeypatch.setattr(voice_core, "encoder", low_model.eval())
+    monkeypatch.setattr(voice_core, "ENCODER_DTYPE", low_dtype)
+    sim_low = voice_core.similarity(*voice_core.embed_utterance_batch(wavs))
+
+    assert abs(sim_fp32 - sim_low) <= LOW_PRECISION_TOLERANCE
+
+def test_embedding_cache_is_namespaced_private_and_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(voice_core, "EMBED_CACHE_DIR", str(tmp_path / "cache"))
+    cache = voice_core.EmbeddingCache("test", maxsize=1, max_files=10)
+    assert cache.dir == str(tmp_path / "cache" / f"test-{voice_core.PRECISION_TAG}")
+    assert os.stat(cache.dir).st_mode & 0o777 == 0o700
+
+    for i in range(25):
+        cache.put(f"{i:064x}", np.full(256, i, dtype=np.float32))
+    assert cache._scan_count() <= 10
+    # Long gone from the 1-entry memory tier, still served from disk
+    np.testing.assert_array_equal(cache.get(f"{23:064x}"), np.full(256, 23, dtype=np.float32))
+
+def test_embedding_cache_ignores_shared_directory(tmp_path, monkeypatch):
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    shared.chmod(0o777)
+    monkeypatch.setattr(voice_core, "EMBED_CACHE_DIR", str(shared))
+    cache = voice_core.EmbeddingCache("test")
+    assert cache.dir == ""
+
+    embed = np.ones(256, dtype=np.float32)
+    cache.put("0" * 64, embed)
+    assert cache.get("0" * 64) is embed
+    assert os.listdir(shared) == []
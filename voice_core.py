@@ -0,0 +1,357 @@
+"""
+Speaker-encoder core shared by the three entry points (api/flask_app.py,
+flask-app.py and the Gradio app.py): torch setup, the VoiceEncoder, the
+batched embedding path, the content-hash caches and the similarity score.
+Importing this module builds the encoder (and warms it up unless WARMUP=0).
+"""
+import os
+import hashlib
+import logging
+import stat
+import tempfile
+import threading
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# --- NumPy compatibility shim (for older libs like resemblyzer) ---
+# NumPy >= 1.24 removed np.bool, np.int, np.float; some libs still reference them.
+if not hasattr(np, "bool"):
+    np.bool = np.bool_  # type: ignore[attr-defined]
+if not hasattr(np, "int"):
+    np.int = int  # type: ignore[attr-defined]
+if not hasattr(np, "float"):
+    np.float = float  # type: ignore[attr-defined]
+# ------------------------------------------------------------------
+
+import torch
+import librosa
+from scipy.linalg.blas import sdot  # scipy ships with librosa
+
+# Import after the NumPy shim so resemblyzer sees the aliases
+from resemblyzer import VoiceEncoder, preprocess_wav
+from resemblyzer.hparams import sampling_rate, mel_window_length, mel_window_step, mel_n_channels
+
+logger = logging.getLogger(__name__)
+
+# GPU=1/0 picks the device. gunicorn_conf.py sets it before forking so its
+# worker layout and the encoder's device always agree; when it is unset
+# (python app.py etc.) the GPU is used if torch can see one.
+if "GPU" in os.environ:
+    GPU = os.environ["GPU"] == "1"
+    if GPU and not torch.cuda.is_available():
+        raise RuntimeError("GPU=1 but torch cannot see a CUDA device")
+else:
+    GPU = torch.cuda.is_available()
+DEVICE = "cuda" if GPU else "cpu"
+
+# Torch runtime settings (before the encoder is built): no autograd (grad mode
+# is per-thread, so request threads also use inference_mode) and all cores on
+# intra-op parallelism for the LSTM GEMMs. On GPU a single thread is enough
+# to feed the device and leaves the cores to decoding and preprocessing.
+torch.set_grad_enabled(False)
+torch.set_num_threads(1 if GPU else (os.cpu_count() or 1))
+try:
+    torch.set_num_interop_threads(1)
+except RuntimeError:
+    pass  # already set once inter-op work has started
+torch.backends.cudnn.benchmark = True
+
+# Speaker encoder
+encoder = VoiceEncoder(device=DEVICE)
+
+def to_low_precision(model: VoiceEncoder) -> tuple:
+    """
+    Reduced-precision copy of the encoder: FP16 weights on GPU, dynamic int8
+    LSTM/Linear on CPU. Returns (model, input dtype). .half() converts in
+    place, so pass a copy if the FP32 model is still needed.
+    """
+    if model.device.type == "cuda":
+        return model.half(), torch.float16
+    return torch.quantization.quantize_dynamic(
+        model, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8
+    ), torch.float32
+
+# Opt-in: ENCODER_LOW_PRECISION=1 trades some accuracy for speed; the drift
+# is bounded by test_low_precision_similarity_matches_fp32.
+ENCODER_LOW_PRECISION = os.environ.get("ENCODER_LOW_PRECISION", "0") == "1"
+ENCODER_DTYPE = torch.float32
+if ENCODER_LOW_PRECISION:
+    encoder, ENCODER_DTYPE = to_low_precision(encoder)
+encoder.eval()
+
+# Upper bound on partial windows (1.6 s each) per encoder forward pass
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "256"))
+
+class LRUCache:
+    """
+    Thread-safe bounded mapping that evicts the least recently used entry.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: np.ndarray) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+def make_private_dir(path: str) -> bool:
+    """
+    Create `path` (mode 0o700) if needed and check that it is a real
+    directory owned by this user with no group/other access, so a
+    directory planted in a world-writable parent (/tmp, /dev/shm) is never
+    trusted. Returns False, with a warning, when it can't be used.
+    """
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        st = os.lstat(path)
+    except OSError as e:
+        logger.warning("Cache directory %s unavailable: %s", path, e)
+        return False
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        logger.warning("Not using cache directory %s: not a private directory owned by uid %d", path, os.getuid())
+        return False
+    return True
+
+# Both caches are keyed by the SHA-256 of the raw audio bytes.
+# Embedding cache: 256-d embeddings, kept in memory and spilled to disk so it
+# survives restarts. Each app and encoder precision gets its own directory
+# under EMBED_CACHE_DIR (the apps decode differently, and FP32/FP16/int8
+# embeddings differ), capped at EMBED_CACHE_MAX_FILES (~1.2 KB each).
+EMBED_CACHE_SIZE = 512
+EMBED_CACHE_DIR = os.environ.get(
+    "EMBED_CACHE_DIR", os.path.join(tempfile.gettempdir(), f"embed_cache-{os.getuid()}")
+)
+EMBED_CACHE_MAX_FILES = int(os.environ.get("EMBED_CACHE_MAX_FILES", "20000"))
+PRECISION_TAG = (
+    "fp16" if ENCODER_DTYPE == torch.float16 else "int8" if ENCODER_LOW_PRECISION else "fp32"
+)
+
+class EmbeddingCache:
+    """
+    Embeddings by content hash: an in-memory LRU in front of .npy files in
+    EMBED_CACHE_DIR/<namespace>-<precision>. When the directory passes
+    max_files, the least recently used tenth is removed.
+    """
+
+    def __init__(self, namespace: str, maxsize: int = EMBED_CACHE_SIZE, max_files: int = EMBED_CACHE_MAX_FILES):
+        self.memory = LRUCache(maxsize)
+        self.max_files = max_files
+        self.dir = os.path.join(EMBED_CACHE_DIR, f"{namespace}-{PRECISION_TAG}")
+        if not (make_private_dir(EMBED_CACHE_DIR) and make_private_dir(self.dir)):
+            self.dir = ""  # memory only
+        self._lock = threading.Lock()
+        # Approximate (other workers write here too); prune() recounts
+        self._files = self._scan_count() if self.dir else 0
+
+    def _scan_count(self) -> int:
+        with os.scandir(self.dir) as it:
+            return sum(entry.name.endswith(".npy") for entry in it)
+
+    def get(self, key: str):
+        """Memory first, then the on-disk spill; None on a miss."""
+        embed = self.memory.get(key)
+        if embed is not None or not self.dir:
+            return embed
+        path = os.path.join(self.dir, f"{key}.npy")
+        try:
+            embed = np.load(path)
+            os.utime(path)  # mtime marks recency for pruning
+        except (OSError, ValueError):
+            return None
+        self.memory.put(key, embed)
+        return embed
+
+    def put(self, key: str, embed: np.ndarray) -> None:
+        self.memory.put(key, embed)
+        if not self.dir:
+            return
+        path = os.path.join(self.dir, f"{key}.npy")
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, embed)
+            os.replace(tmp_path, path)  # atomic, so concurrent readers never see a partial file
+        except OSError as e:
+            logger.warning("Could not persist embedding %s: %s", key[:12], e)
+            return
+        with self._lock:
+            self._files += 1
+            if self._files <= self.max_files:
+                return
+            self._files = self.prune()
+
+    def prune(self) -> int:
+        """
+        Unlink the least recently used files down to 90% of max_files;
+        returns how many are left.
+        """
+        entries = []
+        with os.scandir(self.dir) as it:
+            for entry in it:
+                if not entry.name.endswith(".npy"):
+                    continue  # another worker's in-flight write
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    continue  # removed by another worker meanwhile
+        excess = len(entries) - int(self.max_files * 0.9)
+        for _, path in sorted(entries)[:max(0, excess)]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        return len(entries) - max(0, excess)
+
+# Preprocessed-wav cache: float32 16 kHz output of preprocess_wav (VAD,
+# trim, normalize), so a hit skips decoding and preprocessing and goes
+# straight to the encoder. Entries are ~64 KB per second of speech.
+WAV_CACHE_SIZE = 64
+wav_cache = LRUCache(WAV_CACHE_SIZE)
+
+# Runs independent preprocess_wav passes side by side; librosa's resampling
+# and VAD release the GIL. Sized to the request threads (GUNICORN_THREADS,
+# exported by gunicorn_conf.py) so every in-flight request can preprocess at
+# once, but never past the core count.
+PREPROCESS_WORKERS = int(os.environ.get(
+    "PREPROCESS_WORKERS",
+    max(2, min(int(os.environ.get("GUNICORN_THREADS", 2)), os.cpu_count() or 1)),
+))
+EXECUTOR = ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS)
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+# Mel front end of the encoder (16 kHz, 25 ms window, 10 ms hop, 40
+# channels). The filterbank is built once here; librosa's melspectrogram
+# rebuilds it on every call.
+MEL_N_FFT = int(sampling_rate * mel_window_length / 1000)
+MEL_HOP_LENGTH = int(sampling_rate * mel_window_step / 1000)
+MEL_BASIS = librosa.filters.mel(
+    sr=sampling_rate, n_fft=MEL_N_FFT, n_mels=mel_n_channels
+).astype(np.float32)
+
+def wav_to_mel(wav: np.ndarray) -> np.ndarray:
+    """
+    resemblyzer.audio.wav_to_mel_spectrogram with the cached filterbank:
+    (frames, 40) float32 power mel spectrogram.
+    """
+    spec = np.abs(librosa.stft(wav, n_fft=MEL_N_FFT, hop_length=MEL_HOP_LENGTH)) ** 2
+    return (MEL_BASIS @ spec.astype(np.float32, copy=False)).T
+
+def embed_utterance_batch(wavs: list) -> list:
+    """
+    Batched equivalent of encoder.embed_utterance. Each utterance is cut into
+    fixed-length partial mel windows, the partials of all utterances go
+    through the LSTM together (one forward pass per EMBED_BATCH_SIZE
+    partials), and are then averaged back per utterance and L2-normalized.
+    """
+    mels, counts = [], []
+    for wav in wavs:
+        # The whole front end stays float32 (a no-op unless a float64 wav
+        # slipped in, which would double the STFT's memory traffic)
+        wav = np.asarray(wav, dtype=np.float32)
+        wav_slices, mel_slices = encoder.compute_partial_slices(len(wav))
+        max_wave_length = wav_slices[-1].stop
+        if max_wave_length >= len(wav):
+            wav = np.pad(wav, (0, max_wave_length - len(wav)), "constant")
+        mel = wav_to_mel(wav)
+        mels.extend(mel[s] for s in mel_slices)
+        counts.append(len(mel_slices))
+
+    # Batches can hold thousands of partials; stack and run them
+    # EMBED_BATCH_SIZE at a time so the input tensor and activations stay
+    # bounded (the per-partial mel views are all that's kept in between)
+    with torch.inference_mode():
+        partial_embeds = np.concatenate([
+            encoder(
+                torch.from_numpy(np.stack(mels[i:i + EMBED_BATCH_SIZE]))
+                .to(encoder.device, dtype=ENCODER_DTYPE, non_blocking=True)
+            ).float().cpu().numpy()
+            for i in range(0, len(mels), EMBED_BATCH_SIZE)
+        ])
+
+    embeds = []
+    offset = 0
+    for n in counts:
+        raw_embed = partial_embeds[offset:offset + n].mean(axis=0)
+        embeds.append(raw_embed / np.linalg.norm(raw_embed, 2))
+        offset += n
+    return embeds
+
+def get_embeddings(
+    sources: list,
+    cache: EmbeddingCache,
+    keys: list = None,
+    preprocess=preprocess_wav,
+    wavs=wav_cache,
+    executor: ThreadPoolExecutor = None,
+) -> list:
+    """
+    Embed several audio sources, cached in `cache` by the SHA-256 of the
+    raw audio bytes so repeated comparisons against the same clip skip the
+    encoder. Cache misses go through `preprocess` concurrently and are
+    embedded in one batch. Pass `keys` when the digests are already known
+    (e.g. hashed while downloading); they are required unless the sources
+    are file paths. `wavs` is the preprocessed-wav cache (anything with
+    get/put). Preprocessing runs on the shared EXECUTOR unless `executor`
+    is given (requests with many clips bring their own pool).
+    """
+    if keys is None:
+        keys = [file_sha256(p) for p in sources]
+    embeds = [cache.get(key) for key in keys]
+    for key, embed in zip(keys, embeds):
+        if embed is not None:
+            logger.debug("Embedding cache hit: %s", key[:12])
+
+    misses = [i for i, embed in enumerate(embeds) if embed is None]
+    if not misses:
+        return embeds
+
+    # Reuse preprocessed wavs where cached; preprocess the rest concurrently
+    batch = [wavs.get(keys[i]) for i in misses]
+    todo = [n for n, wav in enumerate(batch) if wav is None]
+    fresh = (executor or EXECUTOR).map(preprocess, [sources[misses[n]] for n in todo])
+    for n, wav in zip(todo, fresh):
+        logger.debug("Audio shape: %s", wav.shape)
+        batch[n] = wav
+        wavs.put(keys[misses[n]], wav)
+    new_embeds = embed_utterance_batch(batch)
+
+    for i, embed in zip(misses, new_embeds):
+        embeds[i] = embed
+        cache.put(keys[i], embed)
+    return embeds
+
+def similarity(embed1: np.ndarray, embed2: np.ndarray) -> float:
+    """
+    Cosine similarity of two unit-norm float32 embeddings. BLAS sdot skips
+    np.dot's generic dispatch, and the clamp stays in plain Python.
+    """
+    return min(1.0, max(-1.0, float(sdot(embed1, embed2))))
+
+# Warm up the encoder at import so the first request doesn't pay for lazy
+# CUDA/cuDNN init and allocator warmup. 3 s of silence spans several partial
+# windows, so the batched path is exercised too. WARMUP=0 skips it (tests,
+# quick scripts).
+if os.environ.get("WARMUP", "1") == "1":
+    try:
+        embed_utterance_batch([np.zeros(3 * sampling_rate, dtype=np.float32)])
+    except Exception as e:
+        logger.warning("Encoder warmup failed: %s", e)